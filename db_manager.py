@@ -1,15 +1,99 @@
+import logging
 import sqlite3
 import os
+from contextlib import contextmanager
+from pathlib import Path
+
+log = logging.getLogger(__name__)
 
 DATABASE_NAME = os.path.expanduser('~/Documents/subtitles.db')
 #DATABASE_NAME = 'Documents/subtitles.db'
 
+# Media rows per INSERT statement in insert_media_batch
+MEDIA_INSERT_CHUNK = 500
+
+_conn = None
+
 def connect_db():
-    return sqlite3.connect(DATABASE_NAME)
+    conn = sqlite3.connect(DATABASE_NAME, cached_statements=256)
+    # WAL lets queries run alongside an update; a 256 MiB page cache and
+    # 256 MiB mmap window keep the indexes in memory on large libraries.
+    conn.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-262144;
+        PRAGMA mmap_size=268435456;
+        PRAGMA foreign_keys=ON;
+    ''')
+    return conn
 
-def create_tables():
-    conn = connect_db()
+def connect_db_ro():
+    """Opens the database read-only for searching.
+
+    Readers don't contend with a concurrent update, and the 1 GiB mmap window
+    lets index pages be read straight from the page cache.
+    """
+    uri = Path(os.path.abspath(DATABASE_NAME)).as_uri() + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, cached_statements=256)
+    conn.executescript('''
+        PRAGMA query_only=1;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-262144;
+        PRAGMA mmap_size=1073741824;
+    ''')
+    return conn
+
+def get_conn():
+    """Returns the shared autocommit connection, opening it on first use."""
+    global _conn
+    if _conn is None:
+        _conn = connect_db()
+        # Transactions are managed explicitly with BEGIN/COMMIT
+        _conn.isolation_level = None
+    return _conn
+
+def close_conn():
+    global _conn
+    if _conn is not None:
+        _conn.close()
+        _conn = None
+
+def enable_bulk_load():
+    """Drops journaling and fsyncs on the shared connection.
+
+    Only safe while rebuilding the database from scratch: a crash leaves a
+    corrupt file, but the rebuild can simply be rerun.
+    """
+    get_conn().executescript('''
+        PRAGMA journal_mode=OFF;
+        PRAGMA synchronous=OFF;
+    ''')
+
+@contextmanager
+def transaction():
+    """Runs the enclosed statements in one write transaction and yields its cursor."""
+    conn = get_conn()
     cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        yield cursor
+    except BaseException:
+        cursor.execute('ROLLBACK')
+        raise
+    else:
+        cursor.execute('COMMIT')
+
+def has_search_index(cursor):
+    """Tells whether the database has the subtitles_fts full-text index."""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'subtitles_fts'")
+    return cursor.fetchone() is not None
+
+def create_tables():
+    with transaction() as cursor:
+        _create_tables(cursor)
+
+def _create_tables(cursor):
     
     # media_files table with phash for uniqueness
     cursor.execute('''
@@ -33,49 +117,143 @@ def create_tables():
         )
     ''')
     
-    conn.commit()
-    conn.close()
+    # Finds a moved file by its content hash when loading with --hash
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_phash ON media_files (phash)')
+    
+    # Lets the before/after context lookups seek straight to neighbouring rows
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sub_media_id ON subtitles (media_id, id)')
+    
+    # Full-text index over subtitles.text, kept in sync by triggers.
+    # The trigram tokenizer keeps the substring semantics of the old LIKE search.
+    fts_exists = has_search_index(cursor)
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS subtitles_fts USING fts5(
+            text,
+            content='subtitles',
+            content_rowid='id',
+            tokenize='trigram'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS subtitles_ai AFTER INSERT ON subtitles BEGIN
+            INSERT INTO subtitles_fts (rowid, text) VALUES (new.id, new.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS subtitles_ad AFTER DELETE ON subtitles BEGIN
+            INSERT INTO subtitles_fts (subtitles_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS subtitles_au AFTER UPDATE ON subtitles BEGIN
+            INSERT INTO subtitles_fts (subtitles_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO subtitles_fts (rowid, text) VALUES (new.id, new.text);
+        END
+    ''')
+    if not fts_exists:
+        # Index any rows from a database created before the FTS table existed
+        cursor.execute("INSERT INTO subtitles_fts (subtitles_fts) VALUES ('rebuild')")
 
 def get_last_modified_time():
-    conn = connect_db()
-    cursor = conn.cursor()
+    cursor = get_conn().cursor()
     cursor.execute('SELECT MAX(modified_time) FROM media_files')
     last_time = cursor.fetchone()[0]
-    conn.close()
     return last_time if last_time else 0
 
-def insert_subtitles(media_id, subtitles_list):
-    conn = connect_db()
-    cursor = conn.cursor()
+def analyze():
+    """Refreshes planner statistics after a bulk load."""
+    get_conn().execute('ANALYZE subtitles')
+
+def insert_subtitles(media_id, subtitles_list, cursor=None):
+    """Batch-inserts subtitles, inside the caller's transaction if a cursor is given."""
+    if cursor is None:
+        with transaction() as cursor:
+            return insert_subtitles(media_id, subtitles_list, cursor)
     
     # Convert subtitles to a list of tuples for batch insertion
     subtitle_data = [(media_id, sub['start_time'], sub['end_time'], sub['text']) for sub in subtitles_list]
     
     cursor.executemany('INSERT INTO subtitles (media_id, start_time, end_time, text) VALUES (?, ?, ?, ?)', subtitle_data)
-    
-    conn.commit()
-    conn.close()
 
-def insert_media_file(file_path, phash, modified_time):
-    conn = connect_db()
-    cursor = conn.cursor()
+def insert_media_file(file_path, phash, modified_time, cursor=None):
+    if cursor is None:
+        with transaction() as cursor:
+            return insert_media_file(file_path, phash, modified_time, cursor)
+    
     try:
         cursor.execute(
             'INSERT INTO media_files (file_path, phash, modified_time) VALUES (?, ?, ?)',
             (file_path, phash, modified_time)
         )
-        conn.commit()
         return cursor.lastrowid
     except sqlite3.IntegrityError:
-        print(f"File {file_path} already exists in the database. Skipping.")
+        log.warning("File %s already exists in the database. Skipping.", file_path)
         return None
-    finally:
-        conn.close()
 
-def get_media_id(file_path):
-    conn = connect_db()
-    cursor = conn.cursor()
+def insert_media_batch(media_list, cursor=None):
+    """Inserts a batch of media files together with their subtitles.
+
+    media_list holds (file_path, phash, modified_time, subtitles_list) tuples.
+    Returns a mapping of file path to new media id; paths already in the
+    database are skipped.
+    """
+    if cursor is None:
+        with transaction() as cursor:
+            return insert_media_batch(media_list, cursor)
+    
+    # One multi-row INSERT ... RETURNING (SQLite 3.35+) per chunk hands back
+    # every new id at once; chunks keep the bound parameters under SQLite's limit
+    media_ids = {}
+    for start in range(0, len(media_list), MEDIA_INSERT_CHUNK):
+        chunk = media_list[start:start + MEDIA_INSERT_CHUNK]
+        placeholders = ', '.join(['(?, ?, ?)'] * len(chunk))
+        params = [value for file_path, phash, modified_time, _ in chunk for value in (file_path, phash, modified_time)]
+        cursor.execute(
+            f'INSERT OR IGNORE INTO media_files (file_path, phash, modified_time) VALUES {placeholders} RETURNING id, file_path',
+            params
+        )
+        media_ids.update((file_path, media_id) for media_id, file_path in cursor.fetchall())
+    
+    # Subtitles are inserted file by file, so each file's ids stay consecutive
+    subtitle_data = []
+    for file_path, _, _, subtitles_list in media_list:
+        media_id = media_ids.get(file_path)
+        if media_id is None:
+            log.warning("File %s already exists in the database. Skipping.", file_path)
+            continue
+        subtitle_data.extend((media_id, sub['start_time'], sub['end_time'], sub['text']) for sub in subtitles_list)
+    
+    cursor.executemany('INSERT INTO subtitles (media_id, start_time, end_time, text) VALUES (?, ?, ?, ?)', subtitle_data)
+    return media_ids
+
+def get_media_paths(cursor=None):
+    """Returns the set of every media file path already in the database."""
+    if cursor is None:
+        cursor = get_conn().cursor()
+    cursor.execute('SELECT file_path FROM media_files')
+    return {row[0] for row in cursor}
+
+def get_media_hashes(cursor=None):
+    """Returns a mapping of phash to file path for every media file in the database."""
+    if cursor is None:
+        cursor = get_conn().cursor()
+    cursor.execute('SELECT phash, file_path FROM media_files')
+    return dict(cursor)
+
+def move_media_file(old_path, new_path, modified_time, cursor=None):
+    """Points an indexed media file at its new location, keeping its subtitles."""
+    if cursor is None:
+        with transaction() as cursor:
+            return move_media_file(old_path, new_path, modified_time, cursor)
+    
+    cursor.execute(
+        'UPDATE media_files SET file_path = ?, modified_time = ? WHERE file_path = ?',
+        (new_path, modified_time, old_path)
+    )
+
+def get_media_id(file_path, cursor=None):
+    if cursor is None:
+        cursor = get_conn().cursor()
     cursor.execute('SELECT id FROM media_files WHERE file_path = ?', (file_path,))
     result = cursor.fetchone()
-    conn.close()
     return result[0] if result else None
\ No newline at end of file
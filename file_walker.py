@@ -1,31 +1,89 @@
+import hashlib
 import os
 
-MEDIA_EXTENSIONS = ['.mp4', '.mkv', '.avi', '.webm', '.m4a', '.mp3']
+try:
+    import blake3
+except ImportError:
+    # hashlib's sha256 still uses the CPU's SHA extensions where available
+    blake3 = None
+
+# Lowercase extensions without the dot, as sets for constant-time lookups
+MEDIA_EXTENSIONS = frozenset({'mp4', 'mkv', 'avi', 'webm', 'm4a', 'mp3'})
+SUBTITLE_EXTENSIONS = frozenset({'srt', 'vtt'})
+
+def _scan_dirs(directory_path):
+    """Yields the list of file DirEntries in each directory below directory_path."""
+    pending_dirs = [directory_path]
+    while pending_dirs:
+        file_entries = []
+        try:
+            with os.scandir(pending_dirs.pop()) as entries:
+                for entry in entries:
+                    # Like os.walk, list symlinked directories but don't descend into them
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append(entry.path)
+                    elif not entry.is_dir():
+                        file_entries.append(entry)
+        except OSError:
+            # Unreadable directories are skipped, as os.walk does
+            continue
+        yield file_entries
+
+def _add_subtitle(subtitle_files, file_name, file_ext, file_path):
+    # Prefer .srt when both formats exist for the same base name
+    if file_name not in subtitle_files or file_ext == 'srt':
+        subtitle_files[file_name] = file_path
+
+def _make_pair(media_entry, subtitle_path):
+    return {
+        'media_path': media_entry.path,
+        'subtitle_path': subtitle_path
+    }
 
 def find_media_and_subtitles(directory_path):
-    media_files = []
+    """Yields media/subtitle pairs as the tree is walked.
+
+    Files are paired by base name in a single pass. Media whose subtitle
+    hasn't been seen yet waits in a dict keyed by base name and is yielded as
+    soon as the subtitle turns up, wherever it is in the tree. Subtitles stay
+    claimable after pairing, so every media file sharing a base name gets one.
+    """
+    waiting_media = {}
     subtitle_files = {}
 
-    for root, _, files in os.walk(directory_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            file_name, file_ext = os.path.splitext(file)
+    for file_entries in _scan_dirs(directory_path):
+        media_entries = []
+        dir_subtitles = {}
+        for entry in file_entries:
+            file_name, _, file_ext = entry.name.rpartition('.')
+            if not file_name:
+                # No extension, or a dotfile such as .mp4
+                continue
+            file_ext = file_ext.lower()
             
-            if file_ext.lower() in MEDIA_EXTENSIONS:
-                media_files.append(file_path)
-            elif file_ext.lower() in ['.srt', '.vtt']:
-                # Store subtitle paths by their base name
-                if file_name not in subtitle_files or file_ext.lower() == '.srt':
-                    subtitle_files[file_name] = file_path
-
-    # Pair media with subtitles
-    file_pairs = []
-    for media_path in media_files:
-        media_name, _ = os.path.splitext(os.path.basename(media_path))
-        if media_name in subtitle_files:
-            file_pairs.append({
-                'media_path': media_path,
-                'subtitle_path': subtitle_files[media_name]
-            })
-
-    return file_pairs
\ No newline at end of file
+            if file_ext in MEDIA_EXTENSIONS:
+                media_entries.append((file_name, entry))
+            elif file_ext in SUBTITLE_EXTENSIONS:
+                _add_subtitle(dir_subtitles, file_name, file_ext, entry.path)
+
+        # Subtitles in this directory complete any media waiting for them
+        for file_name, subtitle_path in dir_subtitles.items():
+            _add_subtitle(subtitle_files, file_name, subtitle_path.rpartition('.')[2].lower(), subtitle_path)
+            for media_entry in waiting_media.pop(file_name, ()):
+                yield _make_pair(media_entry, subtitle_path)
+
+        # Media takes a subtitle from its own directory first, else one seen elsewhere
+        for media_name, media_entry in media_entries:
+            subtitle_path = dir_subtitles.get(media_name) or subtitle_files.get(media_name)
+            if subtitle_path is not None:
+                yield _make_pair(media_entry, subtitle_path)
+            else:
+                waiting_media.setdefault(media_name, []).append(media_entry)
+
+def file_hash(file_path):
+    """Hashes a file's contents in 1 MiB chunks, with blake3 if it is installed."""
+    h = blake3.blake3() if blake3 is not None else hashlib.sha256()
+    with open(file_path, 'rb', buffering=0) as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
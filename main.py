@@ -1,10 +1,52 @@
 import argparse
+import logging
 import os
 import re
 import db_manager
 import file_walker
 import subtitle_parser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import partial
+from itertools import groupby, islice
+
+log = logging.getLogger(__name__)
+
+# Parsed files held in memory before they are written to the database
+LOAD_BATCH_SIZE = 500
+
+# Pairs sent to a worker process per task
+PARSE_CHUNK_SIZE = 16
+
+_UNSAFE_FILENAME_RE = re.compile(r'[^a-zA-Z0-9_]+')
+
+# Fetches every match together with its context lines in one query. A file's
+# subtitles are inserted in one batch, so their ids are consecutive and the
+# neighbours of a match are simply the ids around it. The statements are kept
+# as constants so the connection's statement cache is keyed on one string each.
+_SEARCH_SQL = '''
+    WITH matches (match_id, media_id, match_start) AS ({match_sql})
+    SELECT T1.file_path, matches.match_id, T2.start_time, T2.end_time, T2.text
+    FROM matches
+    JOIN media_files AS T1 ON T1.id = matches.media_id
+    JOIN subtitles AS T2 ON T2.media_id = matches.media_id
+        AND T2.id BETWEEN matches.match_id - ? AND matches.match_id + ?
+    ORDER BY T1.file_path, matches.match_start, matches.match_id, T2.id
+'''
+
+_FTS_SEARCH_SQL = _SEARCH_SQL.format(match_sql='''
+    SELECT T2.id, T2.media_id, T2.start_time
+    FROM subtitles AS T2
+    JOIN subtitles_fts AS F ON F.rowid = T2.id
+    WHERE subtitles_fts MATCH ?
+''')
+
+_LIKE_SEARCH_SQL = _SEARCH_SQL.format(match_sql='''
+    SELECT id, media_id, start_time
+    FROM subtitles
+    WHERE text LIKE ?
+''')
 
 def convert_time_to_seconds(start_time, end_time):
     """Calculates the length of a subtitle entry in seconds."""
@@ -12,189 +54,270 @@ def convert_time_to_seconds(start_time, end_time):
 
 def format_timestamp(seconds):
     """Converts a time in seconds to HH:MM:SS.mmm format for VTT."""
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    remaining_seconds = seconds % 60
+    minutes, remaining_seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
     return f"{hours:02d}:{minutes:02d}:{remaining_seconds:06.3f}"
 
-def write_edl_file(search_results, query_str):
+def safe_filename(query_str):
+    """Sanitizes a query string for use as a filename."""
+    return _UNSAFE_FILENAME_RE.sub('_', query_str)
+
+def write_edl_file(search_results, safe_query):
     """Generates a string in mpv EDL format and writes to a file."""
-    
-    # Sanitize query string for a safe filename
-    safe_query = re.sub(r'[^a-zA-Z0-9_]+', '_', query_str)
     edl_filename = f"{safe_query}.edl"
     edl_path = os.path.join('/tmp', edl_filename)
     
+    # Add the required EDL header
+    parts = ["# mpv EDL v0\n"]
+    
+    for result in search_results:
+        file_path, start_time, length = result
+        # EDL format: file_path, start_time, length
+        parts.append(f"{file_path},{start_time:.2f},{length:.2f}\n")
+    
+    # Build the whole file in memory and write it in one call
     with open(edl_path, 'w') as f:
-        # Add the required EDL header
-        f.write("# mpv EDL v0\n")
-        
-        for result in search_results:
-            file_path, start_time, length = result
-            # EDL format: file_path, start_time, length
-            f.write(f"{file_path},{start_time:.2f},{length:.2f}\n")
+        f.write(''.join(parts))
     
     print(f"\nEDL file saved to: {edl_path}")
 
-def write_text_file(text_results, query_str):
+def write_text_file(text_results, safe_query):
     """Writes the matched subtitles text to a file for review."""
-
-    # Sanitize query string for a safe filename
-    safe_query = re.sub(r'[^a-zA-Z0-9_]+', '_', query_str)
     text_filename = f"{safe_query}.txt"
     text_path = os.path.join('/tmp', text_filename)
     
+    parts = []
+    current_file = None
+    for result in text_results:
+        file_path, start_time, end_time, text = result
+        if file_path != current_file:
+            parts.append(f"\n--- File: {file_path} ---\n")
+            current_file = file_path
+        
+        parts.append(f"[{start_time:.2f} --> {end_time:.2f}]\n{text}\n")
+
     with open(text_path, 'w') as f:
-        current_file = None
-        for result in text_results:
-            file_path, start_time, end_time, text = result
-            if file_path != current_file:
-                f.write(f"\n--- File: {file_path} ---\n")
-                current_file = file_path
-            
-            f.write(f"[{start_time:.2f} --> {end_time:.2f}]\n")
-            f.write(f"{text}\n")
+        f.write(''.join(parts))
 
     print(f"Subtitles text file saved to: {text_path}")
 
-def write_vtt_file(text_results, query_str):
+def write_vtt_file(text_results, safe_query):
     """Writes a combined VTT file with a new, sequential timeline."""
-    safe_query = re.sub(r'[^a-zA-Z0-9_]+', '_', query_str)
     vtt_filename = f"{safe_query}.vtt"
     vtt_path = os.path.join('/tmp', vtt_filename)
     
-    with open(vtt_path, 'w') as f:
-        f.write("WEBVTT\n\n")
+    parts = ["WEBVTT\n\n"]
+    
+    current_time = 0.0
+    for result in text_results:
+        file_path, start_time, end_time, text = result
         
-        current_time = 0.0
-        for result in text_results:
-            file_path, start_time, end_time, text = result
-            
-            # The start and end times in the VTT file are relative to the EDL
-            # We add a small delay to separate the chunks visually
-            start_vtt = current_time + 0.5
-            end_vtt = start_vtt + (end_time - start_time)
-            
-            f.write(f"{format_timestamp(start_vtt)} --> {format_timestamp(end_vtt)}\n")
-            f.write(f"{text}\n\n")
-            
-            current_time = end_vtt + 0.5
+        # The start and end times in the VTT file are relative to the EDL
+        # We add a small delay to separate the chunks visually
+        start_vtt = current_time + 0.5
+        end_vtt = start_vtt + (end_time - start_time)
+        
+        parts.append(f"{format_timestamp(start_vtt)} --> {format_timestamp(end_vtt)}\n{text}\n\n")
+        
+        current_time = end_vtt + 0.5
+
+    with open(vtt_path, 'w') as f:
+        f.write(''.join(parts))
 
     print(f"Combined VTT file saved to: {vtt_path}")
 
-def load_subtitles(directory_path, reload=False):
+def _parse_pair(pair, use_hash=False):
+    """Parses the subtitle file of a media/subtitle pair in a worker process.
+
+    The media file is stat'ed here rather than during the walk, so files already
+    in the database are never touched. With use_hash its content hash is
+    computed here too, so the hashing is spread over the workers along with the
+    parsing. Errors are returned rather than raised, so one bad file (a dangling
+    symlink, an undecodable subtitle) can't abort the whole load.
+    """
+    try:
+        pair['modified_time'] = os.stat(pair['media_path']).st_mtime
+        if use_hash:
+            pair['phash'] = file_walker.file_hash(pair['media_path'])
+        return pair, subtitle_parser.parse_subtitle_file(pair['subtitle_path']), None
+    except Exception as e:
+        return pair, None, f"{type(e).__name__}: {e}"
+
+def _parse_pairs(pairs, use_hash=False):
+    return [_parse_pair(pair, use_hash) for pair in pairs]
+
+def _map_bounded(executor, fn, items, workers):
+    """Like executor.map with a chunksize, but only keeps a window of chunks in flight.
+
+    Executor.map submits every item up front, which drains the walk before the
+    first result comes back. Here at most two chunks per worker are pending, so
+    results stream out while the walk continues and memory stays bounded.
+    """
+    items = iter(items)
+    pending = deque()
+    while True:
+        while len(pending) < 2 * workers:
+            chunk = list(islice(items, PARSE_CHUNK_SIZE))
+            if not chunk:
+                break
+            pending.append(executor.submit(fn, chunk))
+        if not pending:
+            return
+        yield from pending.popleft().result()
+
+def load_subtitles(directory_path, reload=False, use_hash=False):
     """Handles loading or updating the database with subtitles."""
     if reload:
         print("Recreating database...")
-        if os.path.exists(db_manager.DATABASE_NAME):
-            os.remove(db_manager.DATABASE_NAME)
-        db_manager.create_tables()
+        db_manager.close_conn()
+        # Remove the WAL sidecar files too so they aren't replayed into the new database
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_manager.DATABASE_NAME + suffix):
+                os.remove(db_manager.DATABASE_NAME + suffix)
+        db_manager.enable_bulk_load()
+    db_manager.create_tables()
     
-    file_pairs = file_walker.find_media_and_subtitles(directory_path)
-    print(f"Found {len(file_pairs)} media/subtitle pairs.")
-
+    pair_count = 0
+    skipped_count = 0
+    moved_count = 0
+    failed_count = 0
     processed_count = 0
-    for pair in file_pairs:
-        media_path = pair['media_path']
-        subtitle_path = pair['subtitle_path']
+    # Load every file in a single transaction so the whole run commits once
+    with db_manager.transaction() as cursor:
+        # Look up the known files once rather than querying per file
+        existing_paths = set() if reload else db_manager.get_media_paths(cursor)
+        known_hashes = db_manager.get_media_hashes(cursor) if use_hash and not reload else {}
         
-        if not reload:
-            media_id = db_manager.get_media_id(media_path)
-            if media_id is not None:
-                print(f"Skipping {media_path} (already in the database).")
-                continue
-
-        print(f"Processing {media_path}...")
+        def new_pairs():
+            nonlocal pair_count, skipped_count
+            for pair in file_walker.find_media_and_subtitles(directory_path):
+                pair_count += 1
+                if pair['media_path'] in existing_paths:
+                    skipped_count += 1
+                    log.debug("Skipping %s (already in the database).", pair['media_path'])
+                    continue
+                yield pair
+        
+        # New files are inserted a batch at a time: one INSERT for the media rows
+        # and one executemany for all of their subtitles
+        batch = []
         
-        mod_time = os.path.getmtime(media_path)
-        media_id = db_manager.insert_media_file(media_path, str(mod_time), int(mod_time))
+        def flush_batch():
+            nonlocal processed_count
+            media_ids = db_manager.insert_media_batch(batch, cursor)
+            for media_path, _, _, subtitles in batch:
+                if media_path in media_ids:
+                    processed_count += 1
+                    log.info("  Successfully loaded %d subtitles for %s.", len(subtitles), media_path)
+            batch.clear()
         
-        if media_id is not None:
-            subtitles = subtitle_parser.parse_subtitle_file(subtitle_path)
-            db_manager.insert_subtitles(media_id, subtitles)
-            processed_count += 1
-            print(f"  Successfully loaded {len(subtitles)} subtitles.")
+        # Parsing is CPU-bound, so it is spread over worker processes while the
+        # walk is still running; the inserts stay on this connection.
+        workers = os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parse_pairs = partial(_parse_pairs, use_hash=use_hash)
+            for pair, subtitles, error in _map_bounded(executor, parse_pairs, new_pairs(), workers):
+                media_path = pair['media_path']
+                if error is not None:
+                    log.warning("Skipping %s (%s)", media_path, error)
+                    failed_count += 1
+                    continue
+                
+                mod_time = pair['modified_time']
+                # Without --hash the mtime stands in for the content hash
+                phash = pair.get('phash', str(mod_time))
+                
+                # A known hash whose old path is gone is a moved file: keep its subtitles
+                old_path = known_hashes.get(phash)
+                if old_path is not None and not os.path.exists(old_path):
+                    log.info("Moving %s to %s...", old_path, media_path)
+                    db_manager.move_media_file(old_path, media_path, int(mod_time), cursor)
+                    known_hashes[phash] = media_path
+                    moved_count += 1
+                    continue
+                
+                log.info("Processing %s...", media_path)
+                batch.append((media_path, phash, int(mod_time), subtitles))
+                if len(batch) >= LOAD_BATCH_SIZE:
+                    flush_batch()
+            
+            flush_batch()
+
+    if processed_count:
+        db_manager.analyze()
 
+    print(f"Found {pair_count} media/subtitle pairs.")
+    if skipped_count:
+        print(f"Skipped {skipped_count} media files already in the database.")
+    if failed_count:
+        print(f"Skipped {failed_count} media files that could not be read.")
+    if moved_count:
+        print(f"Updated the path of {moved_count} moved media files.")
     print(f"Loaded {processed_count} new media files.")
 
 
 def query_subtitles(query_str, before_lines, after_lines):
     """Performs a global search on the database and handles EDL generation."""
-    conn = db_manager.connect_db()
+    conn = db_manager.connect_db_ro()
     cursor = conn.cursor()
     
-    search_pattern = f"%{query_str}%"
+    # Databases built before the search index existed only get it on --update;
+    # this read-only connection can't create it, so scan with LIKE meanwhile
+    has_index = db_manager.has_search_index(cursor)
+    if not has_index:
+        log.warning("No search index found; run --update to build it. Falling back to a slower scan.")
     
-    cursor.execute('''
-        SELECT T1.file_path, T2.start_time, T2.end_time, T2.id, T1.id, T2.text
-        FROM media_files AS T1
-        JOIN subtitles AS T2 ON T1.id = T2.media_id
-        WHERE T2.text LIKE ?
-        ORDER BY T1.file_path, T2.start_time
-    ''', (search_pattern,))
+    if has_index and len(query_str) >= 3:
+        # Quote the query as a single FTS5 phrase so punctuation isn't parsed as syntax
+        search_pattern = '"' + query_str.replace('"', '""') + '"'
+        search_sql = _FTS_SEARCH_SQL
+    else:
+        # The trigram index can't match fewer than three characters either
+        search_pattern = f"%{query_str}%"
+        search_sql = _LIKE_SEARCH_SQL
+    
+    cursor.execute(search_sql, (search_pattern, max(before_lines, 0), max(after_lines, 0)))
     
-    results = cursor.fetchall()
+    # One group of rows per match: the match plus its before/after lines
+    results = [
+        (file_path, [row[2:] for row in rows])
+        for (file_path, _), rows in groupby(cursor.fetchall(), key=lambda row: row[:2])
+    ]
     
     edl_entries = []
     text_entries = []
     
     if not results:
         print(f"No results found for '{query_str}'")
+        conn.close()
         return
         
     print(f"Found {len(results)} matches for '{query_str}'")
     
-    for row in results:
-        file_path, start_time_match, end_time_match, sub_id_match, media_id_match, text_match = row
-
+    for file_path, clip_subs in results:
         # Skip files that contain a comma in the filename
         if ',' in file_path:
-            print(f"Skipping file with comma in name: {file_path}")
+            log.warning("Skipping file with comma in name: %s", file_path)
             continue
 
-        # Get 'before' subtitles
-        before_subs = []
-        if before_lines > 0:
-            cursor.execute('''
-                SELECT start_time, end_time, text
-                FROM subtitles
-                WHERE media_id = ? AND id < ?
-                ORDER BY id DESC
-                LIMIT ?
-            ''', (media_id_match, sub_id_match, before_lines))
-            before_subs = list(reversed(cursor.fetchall()))
-
-        # Get 'after' subtitles
-        after_subs = []
-        if after_lines > 0:
-            cursor.execute('''
-                SELECT start_time, end_time, text
-                FROM subtitles
-                WHERE media_id = ? AND id > ?
-                ORDER BY id ASC
-                LIMIT ?
-            ''', (media_id_match, sub_id_match, after_lines))
-            after_subs = cursor.fetchall()
-
         # Build the EDL and text entries
-        edl_start_time = before_subs[0][0] if before_subs else start_time_match
-        edl_end_time = after_subs[-1][1] if after_subs else end_time_match
+        edl_start_time = clip_subs[0][0]
+        edl_end_time = clip_subs[-1][1]
         
         edl_length = convert_time_to_seconds(edl_start_time, edl_end_time)
         edl_entries.append((file_path, edl_start_time, edl_length))
         
         # Add all subtitles in the clip to the text entries
-        for sub in before_subs:
-            text_entries.append((file_path, sub[0], sub[1], sub[2]))
-        text_entries.append((file_path, start_time_match, end_time_match, text_match))
-        for sub in after_subs:
-            text_entries.append((file_path, sub[0], sub[1], sub[2]))
+        for start_time, end_time, text in clip_subs:
+            text_entries.append((file_path, start_time, end_time, text))
 
     conn.close()
     
-    write_edl_file(edl_entries, query_str)
-    write_text_file(text_entries, query_str)
-    write_vtt_file(text_entries, query_str)
+    # Sanitize query string once for the three output filenames
+    safe_query = safe_filename(query_str)
+    write_edl_file(edl_entries, safe_query)
+    write_text_file(text_entries, safe_query)
+    write_vtt_file(text_entries, safe_query)
 
 
 def main():
@@ -205,8 +328,11 @@ def main():
     parser.add_argument('--query', dest='query_str', help='Text to search for in subtitles.')
     parser.add_argument('--before', type=int, default=1, help='Number of subtitle entries to include before the match.')
     parser.add_argument('--after', type=int, default=1, help='Number of subtitle entries to include after the match.')
+    parser.add_argument('--hash', action='store_true', help='Identify media files by content hash so moved files are not re-indexed.')
+    parser.add_argument('--verbose', action='store_true', help='Report progress for every file processed.')
     
     args = parser.parse_args()
+    logging.basicConfig(format='%(message)s', level=logging.INFO if args.verbose else logging.WARNING)
 
     # Determine action based on flags
     if args.reload or args.update:
@@ -214,7 +340,7 @@ def main():
             print("Error: --reload and --update flags require a directory argument.")
             parser.print_help()
             exit(1)
-        load_subtitles(args.directory, reload=args.reload)
+        load_subtitles(args.directory, reload=args.reload, use_hash=args.hash)
     elif args.query_str:
         query_subtitles(args.query_str, args.before, args.after)
     else:
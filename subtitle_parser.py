@@ -1,45 +1,119 @@
-import pysrt
+import hashlib
+import logging
+import os
+import pickle
 import re
-from webvtt import WebVTT
 
-def parse_srt(file_path):
-    subs = pysrt.open(file_path, encoding='utf-8')
+log = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.expanduser('~/.cache/subs_parse')
+# Bump when the parsed output changes so stale cache entries are ignored
+CACHE_VERSION = 3
+
+# Set once a cache write has failed, so the warning isn't repeated per file
+_cache_write_failed = False
+
+# Text of a cue: the non-blank lines following its timing line
+_CUE_TEXT = r'[^\n]*\n?((?:[ \t]*\S[^\n]*\n?)*)'
+
+# 00:00:01,000 --> 00:00:02,500
+_SRT_RE = re.compile(
+    r'^[ \t]*(\d+):(\d{2}):(\d{2})[,.](\d{3})[ \t]*-->[ \t]*(\d+):(\d{2}):(\d{2})[,.](\d{3})' + _CUE_TEXT,
+    re.M
+)
+
+# 00:01.000 --> 00:00:02.000 align:start (hours are optional in VTT)
+_VTT_RE = re.compile(
+    r'^[ \t]*(?:(\d+):)?(\d{2}):(\d{2})\.(\d{3})[ \t]+-->[ \t]+(?:(\d+):)?(\d{2}):(\d{2})\.(\d{3})' + _CUE_TEXT,
+    re.M
+)
+
+# Cue markup such as <c.yellow>, </c>, <i> and karaoke timestamps <00:00:00.500>
+_VTT_TAG_RE = re.compile(r'<[^>\n]*>')
+
+_TS_RE = re.compile(r'(?:(\d+):)?(\d{2}):(\d{2})\.(\d{3})')
+
+def _to_seconds(hours, minutes, seconds, milliseconds):
+    return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds) + int(milliseconds) / 1000
+
+def _parse_cues(pattern, file_path, strip_tags=False):
+    # utf-8-sig drops a leading BOM; universal newlines normalise \r\n
+    with open(file_path, encoding='utf-8-sig') as f:
+        data = f.read()
     subtitles_list = []
-    for sub in subs:
-        start_time = sub.start.hours * 3600 + sub.start.minutes * 60 + sub.start.seconds + sub.start.milliseconds / 1000
-        end_time = sub.end.hours * 3600 + sub.end.minutes * 60 + sub.end.seconds + sub.end.milliseconds / 1000
-        text = sub.text.replace('\n', ' ')
+    for m in pattern.finditer(data):
+        start_time = _to_seconds(*m.group(1, 2, 3, 4))
+        end_time = _to_seconds(*m.group(5, 6, 7, 8))
+        text = m.group(9)
+        if strip_tags:
+            text = _VTT_TAG_RE.sub('', text)
+        text = text.strip().replace('\n', ' ')
         subtitles_list.append({'start_time': start_time, 'end_time': end_time, 'text': text})
     return subtitles_list
 
+def parse_srt(file_path):
+    return _parse_cues(_SRT_RE, file_path)
+
 def parse_vtt(file_path):
     try:
-        webvtt_parser = WebVTT()
-        subs = webvtt_parser.read(file_path)
-        subtitles_list = []
-        for caption in subs:
-            start_time = parse_vtt_timestamp(caption.start)
-            end_time = parse_vtt_timestamp(caption.end)
-            text = caption.text.replace('\n', ' ')
-            subtitles_list.append({'start_time': start_time, 'end_time': end_time, 'text': text})
-        return subtitles_list
+        return _parse_cues(_VTT_RE, file_path, strip_tags=True)
     except Exception as e:
         print(f"Error parsing VTT file {file_path}: {e}")
         return []
 
 def parse_vtt_timestamp(timestamp_str):
-    parts = re.split(r'[:.]', timestamp_str)
-    if len(parts) == 3: # 00:00.000 format
-        minutes, seconds, milliseconds = map(int, parts)
-        return minutes * 60 + seconds + milliseconds / 1000
-    elif len(parts) == 4: # 00:00:00.000 format
-        hours, minutes, seconds, milliseconds = map(int, parts)
-        return hours * 3600 + minutes * 60 + seconds + milliseconds / 1000
-    return 0
+    m = _TS_RE.match(timestamp_str)
+    if m is None:
+        return 0
+    return _to_seconds(*m.groups())
+
+def _cache_path(file_path):
+    key = f"{CACHE_VERSION}:{os.path.abspath(file_path)}".encode('utf-8', 'surrogateescape')
+    return os.path.join(CACHE_DIR, hashlib.sha1(key).hexdigest() + '.pkl')
+
+def _file_stamp(file_path):
+    # Compared for equality, not ordering, so a file replaced by one with an
+    # older mtime (cp -p, rsync -a, unzip) still invalidates the entry
+    st = os.stat(file_path)
+    return st.st_mtime_ns, st.st_size
+
+def _load_cached(cache_path, stamp):
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_stamp, subtitles_list = pickle.load(f)
+        if cached_stamp == stamp:
+            return subtitles_list
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+    return None
+
+def _store_cached(cache_path, stamp, subtitles_list):
+    global _cache_write_failed
+    # Write to a temporary file first so a reader never sees a partial pickle
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((stamp, subtitles_list), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        if not _cache_write_failed:
+            _cache_write_failed = True
+            log.warning("Could not cache parsed subtitles in %s: %s", CACHE_DIR, e)
 
 def parse_subtitle_file(file_path):
+    """Parses a subtitle file, reusing the cached result if the file is unchanged."""
+    cache_path = _cache_path(file_path)
+    stamp = _file_stamp(file_path)
+    subtitles_list = _load_cached(cache_path, stamp)
+    if subtitles_list is None:
+        subtitles_list = _parse_subtitle_file(file_path)
+        _store_cached(cache_path, stamp, subtitles_list)
+    return subtitles_list
+
+def _parse_subtitle_file(file_path):
     if file_path.endswith('.srt'):
         return parse_srt(file_path)
     elif file_path.endswith('.vtt'):
         return parse_vtt(file_path)
-    return []
\ No newline at end of file
+    return []